@@ -1,6 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import charset_normalizer
+import codecs
 import io
+import threading
+from operator import itemgetter
+
+# numba 为可选依赖：未安装时大文件也走 NumPy 路径
+try:
+    import numba
+except ImportError:
+    numba = None
 
 # --- 页面设置 ---
 st.set_page_config(page_title="EPR 精细化核算工具", page_icon="📊", layout="wide")
@@ -38,42 +49,248 @@ COUNTRY_MAP = {
     'IN': '印度 (IN)'
 }
 
+# --- 0.1 材质重量列 & CSV 列类型 (显式指定类型，避免逐行推断) ---
+MATERIAL_COLS = [
+    'PAPER_KG', 'PLASTIC_KG', 
+    'GLASS_KG', 'ALUMINUM_KG', 'STEEL_KG', 'WOOD_KG', 'OTHER_KG'
+]
+
+# 报表固定输出的申报类别 (顺序即表格行顺序)
+TARGET_CATEGORIES = ['Primary Packaging', 'Secondary Packaging']
+
+# NumPy 汇总路径：类别数不超过该值时按布尔掩码求和 (两个类别时与 reduceat 耗时相当，且无需排序)；
+# 超过时改用 排序 + np.add.reduceat，掩码求和每个类别都要扫描并拷贝一次，reduceat 只需一次
+MASK_SUM_MAX_CATEGORIES = 2
+
+# 核算只用到这些列，其余列不解析
+NEEDED_COLS = ['SHIP_TO_COUNTRY_CODE', 'EPR_CATEGORY', 'TOTAL_UNITS_SOLD'] + MATERIAL_COLS
+
+# 件数列可能存在空值，使用 float64 以免整型转换失败
+# 重量保持 float64：申报数值需与原始数据一致，float32 会引入误差 (如 0.1 变成 0.10000000149)
+CSV_DTYPES = {
+    'SHIP_TO_COUNTRY_CODE': 'category',
+    'TOTAL_UNITS_SOLD': 'float64',
+    **{col: 'float64' for col in MATERIAL_COLS}
+}
+
+# 记录数超过该值且已安装 numba 时，改用 JIT 内核汇总 (小文件编译/调度开销不划算)
+# 注意：新进程中第一次处理大文件需先 JIT 编译内核 (约 4 秒)，磁盘缓存写好后才免去这部分开销；
+# cache=True 会把编译结果写入 app.py 旁的 __pycache__，部署目录只读时可用 NUMBA_CACHE_DIR 指定可写目录
+# 各会话的脚本线程共用一把锁串行调用内核：缺少 TBB/OpenMP 时 numba 回退到 workqueue 线程层，并发调用会直接终止进程
+NUMBA_MIN_ROWS = 50_000
+
 # --- 侧边栏 ---
 with st.sidebar:
     st.header("📂 1. 文件上传")
     uploaded_file = st.file_uploader("请上传 Amazon EPR 原始数据.csv", type=["csv"])
 
+# --- 辅助函数：以指定编码解析 CSV 字节 ---
+def read_csv_bytes(file_bytes, encoding):
+    """优先使用 PyArrow 多线程引擎解析，失败时回退到默认 C 引擎"""
+    # 先只读表头，挑出文件中实际存在的所需列 (缺失的列不会报错，后续统一补 0)
+    # PyArrow 引擎不支持可调用的 usecols，因此这里传入列名列表
+    header = pd.read_csv(io.BytesIO(file_bytes), encoding=encoding, nrows=0).columns
+    usecols = [col for col in header if col in NEEDED_COLS]
+
+    try:
+        return pd.read_csv(io.BytesIO(file_bytes), encoding=encoding, engine='pyarrow', usecols=usecols, dtype=CSV_DTYPES)
+    except UnicodeDecodeError:
+        raise
+    except Exception:
+        # PyArrow 不支持的编码/格式，交给 C 引擎处理 (编码错误时同样抛出 UnicodeDecodeError)
+        return pd.read_csv(io.BytesIO(file_bytes), encoding=encoding, usecols=usecols, dtype=CSV_DTYPES)
+
 # --- 辅助函数：尝试多种编码读取 CSV ---
-def load_csv_safe(file):
-    """尝试使用不同的编码读取 CSV 文件，解决 Excel 导出乱码问题"""
+@st.cache_resource(max_entries=4)
+def load_csv_safe(file_id, _file_bytes):
+    """尝试使用不同的编码读取 CSV 文件，解决 Excel 导出乱码问题
+
+    以上传文件的 file_id 作为缓存键 (下划线开头的 _file_bytes 不参与哈希)，
+    解析结果作为共享资源缓存：重新运行时直接返回同一个 DataFrame，不做反序列化拷贝。
+    调用方只读不改 (按国家切片后会经 reindex 得到新的 DataFrame，不会写回缓存)。
+    该缓存跨会话共享，只保留最近 4 个文件，避免长期运行时内存无限增长；被淘汰后调用方可用 _file_bytes 重新解析。
+    """
     encodings = ['utf-8', 'gbk', 'gb18030', 'cp1252', 'latin1']
+
+    # 先根据文件开头 64 KB 推测编码，猜中列表中的编码时优先尝试，只需解析一次；猜错再按上面的顺序依次重试
+    # 只在上面的列表内调整顺序：对中文文件可能误判为 cp949 等编码，直接采用会静默产生乱码
+    guess = charset_normalizer.from_bytes(_file_bytes[:65536]).best()
+    if guess is not None:
+        known = {codecs.lookup(e).name: e for e in encodings}
+        detected = known.get(codecs.lookup(guess.encoding).name)
+        if detected is not None:
+            encodings = [detected] + [e for e in encodings if e != detected]
     
     for encoding in encodings:
         try:
-            file.seek(0) # 每次重试前，将文件指针重置到开头
-            return pd.read_csv(file, encoding=encoding), encoding
+            df = read_csv_bytes(_file_bytes, encoding)
         except UnicodeDecodeError:
             continue
+
+        # 以国家代码 (分类类型) 作为排序索引，按国家筛选时只需对索引切片
+        # 没有国家代码的行不会出现在任何站点的报表中，先去掉，保证索引单调 (标签切片依赖这一点)
+        if 'SHIP_TO_COUNTRY_CODE' in df.columns:
+            df = df.dropna(subset=['SHIP_TO_COUNTRY_CODE']).set_index('SHIP_TO_COUNTRY_CODE').sort_index()
+        return df, encoding
     return None, None
 
+# --- 辅助函数：numba JIT 内核，单次遍历完成 逐行总重量 + 按申报类别汇总 ---
+if numba is not None:
+    # 不启用 nnan 等标志：件数列可能含空值，需要保留 isnan 判断
+    @numba.njit(parallel=True, fastmath={'reassoc', 'contract'}, cache=True)
+    def row_sum_and_group(units, weights, cat_codes, n_groups, n_chunks):
+        """units (N,) / weights (N, 7) / cat_codes (N,) int8 (TARGET_CATEGORIES 下标，-1=其他)
+
+        返回 (n_groups, 9) 的汇总：件数、7 种材质重量、总重量；分成 n_chunks 块并行累加后再合并。
+        """
+        n_rows, n_cols = weights.shape
+        chunk_size = (n_rows + n_chunks - 1) // n_chunks
+        partials = np.zeros((n_chunks, n_groups, n_cols + 2))
+
+        for chunk in numba.prange(n_chunks):
+            start = chunk * chunk_size
+            stop = min(start + chunk_size, n_rows)
+            for i in range(start, stop):
+                code = cat_codes[i]
+                if code < 0:
+                    continue
+                if not np.isnan(units[i]):
+                    partials[chunk, code, 0] += units[i]
+                total = 0.0
+                for j in range(n_cols):
+                    partials[chunk, code, j + 1] += weights[i, j]
+                    total += weights[i, j]
+                partials[chunk, code, n_cols + 1] += total
+
+        sums = np.zeros((n_groups, n_cols + 2))
+        for chunk in range(n_chunks):
+            sums += partials[chunk]
+        return sums
+
+# --- 辅助函数：申报类别 -> int8 代码 ---
+def category_codes(categories):
+    """返回 TARGET_CATEGORIES 中的下标 (int8)，其他类别/空值为 -1"""
+    cat_codes = np.full(len(categories), -1, dtype=np.int8)
+    for code, category in enumerate(TARGET_CATEGORIES):
+        cat_codes[categories == category] = code
+    return cat_codes
+
+# --- 辅助函数：numba 内核调用锁 ---
+@st.cache_resource
+def get_numba_lock():
+    """所有会话共享同一把锁 (Streamlit 每次重新运行都会重新执行脚本，模块级的锁无法跨会话共享)"""
+    return threading.Lock()
+
+# --- 辅助函数：按国家筛选并汇总 (结果按 file_id + 国家 缓存，只缓存很小的汇总表) ---
+@st.cache_data(max_entries=64)
+def preprocess(file_id, _file_bytes, country):
+    """筛选指定国家的数据并按申报类别汇总，返回 (汇总表, 记录数)"""
+    df, _ = load_csv_safe(file_id, _file_bytes)
+
+    # 3. 根据选择的国家筛选数据
+    # 在单调的排序索引上做标签切片 (二分查找定位，O(log n))；切片总是返回 DataFrame，即使该国家只有一行
+    df_target = df.loc[country:country]
+
+    # 4. 数据预处理
+    # 确保列存在并填充0 (缺失的列整列补 0，空值一次性整块填充)
+    df_target = df_target.reindex(columns=df_target.columns.union(MATERIAL_COLS), fill_value=0.0)
+    df_target[MATERIAL_COLS] = df_target[MATERIAL_COLS].fillna(0.0).astype('float64')
+
+    # 5 - 7. 计算总重量并构建强制结构表 (固定的几个类别，不走 pandas groupby)
+    cols_to_sum = ['TOTAL_UNITS_SOLD', *MATERIAL_COLS, 'Total_Weight_KG']
+    
+    # 件数单独取值：可能含空值，汇总时需跳过
+    units = df_target['TOTAL_UNITS_SOLD'].to_numpy()
+    categories = df_target['EPR_CATEGORY'].to_numpy()
+
+    if numba is not None and len(df_target) > NUMBA_MIN_ROWS:
+        # 大文件：JIT 内核一次遍历同时算出逐行总重量与各类汇总
+        cat_codes = category_codes(categories)
+        weights = np.ascontiguousarray(df_target[MATERIAL_COLS].to_numpy())
+        # 线程数在外部读取后传入，内核不引用运行时全局状态，cache=True 才能落盘复用
+        with get_numba_lock():
+            sums = row_sum_and_group(
+                np.ascontiguousarray(units), weights, cat_codes, len(TARGET_CATEGORIES), numba.get_num_threads()
+            )
+    else:
+        # 逐行计算总重量，随后与各材质一起汇总，无需再做一次横向求和
+        df_target['Total_Weight_KG'] = df_target[MATERIAL_COLS].sum(axis=1)
+        weights = df_target[cols_to_sum[1:]].to_numpy()
+
+        if len(TARGET_CATEGORIES) <= MASK_SUM_MAX_CATEGORIES:
+            # 类别很少：直接按布尔掩码求和
+            sums = []
+            for category in TARGET_CATEGORIES:
+                mask = categories == category
+                # nansum 与 groupby().sum() 一样跳过空值；文件中没有的类别自然得到 0
+                sums.append([np.nansum(units[mask]), *weights[mask].sum(axis=0)])
+        else:
+            # 类别较多：按类别代码稳定排序 (int8 走基数排序)，再用 np.add.reduceat 对每段连续行一次性求和，不建哈希表
+            cat_codes = category_codes(categories)
+            order = np.argsort(cat_codes, kind='stable')
+            codes_sorted = cat_codes[order]
+            boundaries = np.concatenate([[0], np.flatnonzero(codes_sorted[1:] != codes_sorted[:-1]) + 1])
+            # 件数空值按 0 计 (与 groupby().sum() 一样跳过空值)
+            unit_sums = np.add.reduceat(np.nan_to_num(units[order]), boundaries)
+            weight_sums = np.add.reduceat(weights[order], boundaries, axis=0)
+
+            # 各段映射回固定类别，文件中没有的类别保持 0，其他类别直接丢弃
+            sums = np.zeros((len(TARGET_CATEGORIES), len(cols_to_sum)))
+            for segment, code in enumerate(codes_sorted[boundaries]):
+                if code >= 0:
+                    sums[code, 0] = unit_sums[segment]
+                    sums[code, 1:] = weight_sums[segment]
+    df_final = pd.DataFrame(sums, index=TARGET_CATEGORIES, columns=cols_to_sum)
+
+    # 8. 添加总计
+    # 直接按行赋值追加，避免 concat 重新分配与对齐整张表
+    df_final.loc['总计 (Grand Total)'] = df_final.to_numpy().sum(axis=0)
+
+    return df_final, len(df_target)
+
+# --- 辅助函数：生成 Excel 文件字节 (结果按 表格内容 + 工作表名 缓存) ---
+@st.cache_data(hash_funcs={pd.DataFrame: lambda d: pd.util.hash_pandas_object(d, index=True).values.tobytes()})
+def build_excel_bytes(df_display, sheet_name):
+    """把展示用的汇总表写成 xlsx，返回文件字节，重复渲染页面时直接复用"""
+    buffer = io.BytesIO()
+    # constant_memory: 逐行写出，峰值内存不随表格行数增长
+    excel_options = {'constant_memory': True, 'strings_to_numbers': False}
+    with pd.ExcelWriter(buffer, engine='xlsxwriter', engine_kwargs={'options': excel_options}) as writer:
+        workbook = writer.book
+        worksheet = workbook.add_worksheet(sheet_name)
+        
+        # 调整列宽 (constant_memory 模式下必须在写入数据之前设置)
+        worksheet.set_column('A:A', 20) 
+        worksheet.set_column('B:B', 35) 
+        worksheet.set_column('C:K', 15) 
+
+        # 逐行写入：to_excel 按列写单元格，而 constant_memory 模式下已写完的行不能再修改
+        header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+        worksheet.write_row(0, 0, df_display.columns.tolist(), header_format)
+        for row_idx, row in enumerate(df_display.to_numpy(dtype=object).tolist(), start=1):
+            worksheet.write_row(row_idx, 0, row)
+
+    return buffer.getvalue()
+
 # --- 核心逻辑 ---
 if uploaded_file is not None:
     try:
-        # 1. 使用增强的读取函数
-        df, loaded_encoding = load_csv_safe(uploaded_file)
+        # 1. 使用增强的读取函数 (按 file_id 缓存，重新运行时不再对整个文件做哈希)
+        file_bytes = uploaded_file.getvalue()
+        df, loaded_encoding = load_csv_safe(uploaded_file.file_id, file_bytes)
 
         if df is None:
             st.error("❌ 无法读取文件编码。请尝试在 Excel 中将文件另存为 'CSV UTF-8 (逗号分隔)' 格式。")
             st.stop()
         
         # 检查必要的列是否存在
-        if 'SHIP_TO_COUNTRY_CODE' not in df.columns:
+        if df.index.name != 'SHIP_TO_COUNTRY_CODE':
             st.error(f"❌ 错误：读取成功 (编码: {loaded_encoding})，但找不到 'SHIP_TO_COUNTRY_CODE' 列。")
             st.stop()
 
         # 2. 获取文件包含的所有国家代码
-        available_countries = df['SHIP_TO_COUNTRY_CODE'].dropna().unique().tolist()
-        available_countries.sort()
+        # 国家索引为分类类型，直接读取已有的类别列表，无需逐行哈希去重
+        available_countries = sorted(df.index.categories.dropna().tolist())
 
         if not available_countries:
             st.error("❌ 错误：文件中没有有效的国家代码数据。")
@@ -84,51 +301,23 @@ if uploaded_file is not None:
             # 默认选中德国(DE)，如果文件里没有DE，就选第一个
             default_index = available_countries.index('DE') if 'DE' in available_countries else 0
             
-            # format_func 负责把 'DE' 显示成 '德国 (DE)'
-            selected_country = st.sidebar.selectbox(
+            # 预先生成 (代码, 中文名) 选项，format_func 直接取中文名，把 'DE' 显示成 '德国 (DE)'
+            country_options = [(code, COUNTRY_MAP.get(code, code)) for code in available_countries]
+            selected_country, display_country_name = st.sidebar.selectbox(
                 "请选择要核算的国家:", 
-                available_countries, 
+                country_options, 
                 index=default_index,
-                format_func=lambda x: COUNTRY_MAP.get(x, x)  # ✨ 这里的魔法让下拉菜单显示中文
+                format_func=itemgetter(1)  # ✨ 这里的魔法让下拉菜单显示中文
             )
 
-            # 3. 根据选择的国家筛选数据
-            df_target = df[df['SHIP_TO_COUNTRY_CODE'] == selected_country].copy()
-            
-            # 获取当前选中的中文名用于展示
-            display_country_name = COUNTRY_MAP.get(selected_country, selected_country)
-
-            st.info(f"读取成功 | 当前站点: **{display_country_name}** | 记录数: {len(df_target)}")
-
-            # 4. 数据预处理
-            material_cols = [
-                'PAPER_KG', 'PLASTIC_KG', 
-                'GLASS_KG', 'ALUMINUM_KG', 'STEEL_KG', 'WOOD_KG', 'OTHER_KG'
-            ]
-            
-            # 确保列存在并填充0
-            for col in material_cols:
-                if col not in df_target.columns:
-                    df_target[col] = 0.0
-                df_target[col] = df_target[col].fillna(0.0)
-
-            # 5. 计算逻辑
-            
-            # 6. 构建强制结构表
-            target_categories = ['Primary Packaging', 'Secondary Packaging']
-            
-            cols_to_sum = ['TOTAL_UNITS_SOLD'] + material_cols
-            
-            grouped = df_target.groupby('EPR_CATEGORY')[cols_to_sum].sum()
-            df_final = grouped.reindex(target_categories, fill_value=0)
+            # --- 侧边栏选择下载格式：默认 CSV (生成开销远小于 XLSX)，需要 Excel 时再选 XLSX ---
+            st.sidebar.header("📥 3. 下载格式")
+            download_format = st.sidebar.radio("请选择导出文件格式:", ["CSV", "XLSX"], index=0)
 
-            # 7. 计算总重量
-            df_final['Total_Weight_KG'] = df_final[material_cols].sum(axis=1)
+            # 3 - 8. 筛选、预处理与汇总 (已缓存，切换国家时复用之前的结果)
+            df_final, record_count = preprocess(uploaded_file.file_id, file_bytes, selected_country)
 
-            # 8. 添加总计
-            grand_total_row = df_final.sum()
-            grand_total_row.name = '总计 (Grand Total)'
-            df_final = pd.concat([df_final, grand_total_row.to_frame().T])
+            st.info(f"读取成功 | 当前站点: **{display_country_name}** | 记录数: {record_count}")
 
             # 9. 格式化表格
             row_mapping = {
@@ -162,43 +351,42 @@ if uploaded_file is not None:
             st.divider()
             st.success(f"✅ {display_country_name} 站点核算完成！")
             
-            format_dict = {
-                '申报总件数 (Units)': '{:.0f}',
-                '纸质 (Paper) kg': '{:.3f}',
-                '塑料 (Plastic) kg': '{:.3f}',
-                '玻璃 (Glass) kg': '{:.3f}',
-                '铝 (Aluminum) kg': '{:.3f}',
-                '铁 (Steel) kg': '{:.3f}',
-                '木头 (Wood) kg': '{:.3f}',
-                '其他 (Other) kg': '{:.3f}',
-                '总重量 (Total Weight) kg': '{:.3f}'
+            # 数字格式交给前端渲染 (column_config)，不再用 Styler 逐个单元格格式化字符串
+            column_config = {
+                col_mapping['TOTAL_UNITS_SOLD']: st.column_config.NumberColumn(format='%.0f'),
+                **{
+                    col_mapping[col]: st.column_config.NumberColumn(format='%.3f')
+                    for col in [*MATERIAL_COLS, 'Total_Weight_KG']
+                }
             }
 
             st.dataframe(
-                df_display.style.format(format_dict), 
+                df_display, 
                 use_container_width=True,
-                hide_index=True
+                hide_index=True,
+                column_config=column_config
             )
 
             # 11. 导出
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+            if download_format == "XLSX":
                 sheet_name = f'{selected_country}_明细数据'
-                df_display.to_excel(writer, sheet_name=sheet_name, index=False)
-                worksheet = writer.sheets[sheet_name]
-                
-                # 调整列宽
-                worksheet.set_column('A:A', 20) 
-                worksheet.set_column('B:B', 35) 
-                worksheet.set_column('C:K', 15) 
-
-            file_name = f"{display_country_name}_包装法_明细申报表.xlsx"
+                file_data = build_excel_bytes(df_display, sheet_name)
+                file_name = f"{display_country_name}_包装法_明细申报表.xlsx"
+                mime = "application/vnd.ms-excel"
+            else:
+                # 与页面表格保持一致：件数写成整数，重量保留 3 位小数
+                # utf-8-sig 带 BOM，Excel 直接打开 CSV 时中文不乱码
+                units_col = col_mapping['TOTAL_UNITS_SOLD']
+                df_csv = df_display.assign(**{units_col: df_display[units_col].round().astype('int64')})
+                file_data = df_csv.to_csv(index=False, float_format='%.3f').encode('utf-8-sig')
+                file_name = f"{display_country_name}_包装法_明细申报表.csv"
+                mime = "text/csv"
             
             st.download_button(
                 label=f"📥 下载表格: {file_name}",
-                data=buffer.getvalue(),
+                data=file_data,
                 file_name=file_name,
-                mime="application/vnd.ms-excel"
+                mime=mime
             )
 
     except Exception as e: